@@ -1,85 +1,540 @@
+import atexit
+import collections
 import contextlib
+import errno
+import hashlib
 import io
+import json
 import os
+import queue
+import random
+import shutil
 import sys
 import tempfile
-
-try:
-    import fcntl
-except ImportError:
-    fcntl = None
+import threading
+import time
+import uuid
+import warnings
 
 __version__ = '1.3.0'
 
 
-PY2 = sys.version_info[0] == 2
+_path_to_unicode = os.fsdecode
+_path_to_bytes = os.fsencode
+
+
+DEFAULT_MODE = "w"
+
+# Large enough for filesystems to allocate contiguously and to need few
+# write() calls for medium-sized files.
+_DEFAULT_BUFFERING = 64 * 1024
+
 
-text_type = unicode if PY2 else str  # noqa
+# Flushes file contents and metadata to the drive.
+_data_fsync = os.fsync
+# Additionally flushes the drive's own write cache, where that is different.
+_durable_fsync = os.fsync
 
 
-def _path_to_unicode(x):
-    if not isinstance(x, text_type):
-        return x.decode(sys.getfilesystemencoding())
-    return x
+_O_SEQUENTIAL = getattr(os, 'O_SEQUENTIAL', 0)
 
+# Same flags as tempfile.mkstemp() uses.
+_TEMPFILE_FLAGS = (os.O_RDWR | os.O_CREAT | os.O_EXCL |
+                   getattr(os, 'O_NOFOLLOW', 0) |
+                   getattr(os, 'O_NOINHERIT', 0) |
+                   getattr(os, 'O_BINARY', 0))
 
-DEFAULT_MODE = "wb" if PY2 else "w"
 
+def _parent_directory(path):
+    return os.path.dirname(path) or '.'
 
-_proper_fsync = os.fsync
+
+def _temporary_name(directory, prefix, suffix):
+    return os.path.join(directory, prefix + uuid.uuid4().hex[:16] + suffix)
+
+
+def _create_temporary(directory, prefix, suffix, flags=0):
+    '''Create a new file like :py:func:`tempfile.mkstemp`, but with a
+    cheaper source of random names. Return the descriptor and the name.'''
+    while True:
+        name = _temporary_name(directory, prefix, suffix)
+        try:
+            return os.open(name, _TEMPFILE_FLAGS | flags, 0o600), name
+        except OSError as e:
+            # Practically impossible with 64 random bits.
+            if e.errno != errno.EEXIST:
+                raise
 
 
 if sys.platform != 'win32':
+    import fcntl
+
     if hasattr(fcntl, 'F_FULLFSYNC'):
-        def _proper_fsync(fd):
+        def _durable_fsync(fd):
             # https://lists.apple.com/archives/darwin-dev/2005/Feb/msg00072.html
             # https://developer.apple.com/library/mac/documentation/Darwin/Reference/ManPages/man2/fsync.2.html
             # https://github.com/untitaker/python-atomicwrites/issues/6
             fcntl.fcntl(fd, fcntl.F_FULLFSYNC)
 
+    class _DirectoryHandle(object):
+        fd = None
+
+        def __init__(self, directory):
+            self.fd = os.open(directory, 0)
+            st = os.fstat(self.fd)
+            self.key = (st.st_dev, st.st_ino)
+            # Threads currently using the fd, and whether it was dropped
+            # from the cache. Only changed under _directory_cache_lock.
+            self.users = 0
+            self.evicted = False
+
+        def close(self):
+            if self.fd is not None:
+                fd, self.fd = self.fd, None
+                os.close(fd)
+
+        def __del__(self):
+            self.close()
+
+    # Keep the last few directories open, so that repeated writes into the
+    # same directory don't have to open() and close() it every time.
+    _directory_cache = collections.OrderedDict()
+    _directory_cache_size = 32
+    _directory_cache_lock = threading.Lock()
+
+    def _evict_directory_handle(handle):
+        # Closed right away unless another thread still uses it, then by
+        # the last one releasing it. Called with _directory_cache_lock held.
+        handle.evicted = True
+        if not handle.users:
+            handle.close()
+
+    def _get_directory_handle(directory):
+        # The directory might have been replaced since it was cached.
+        st = os.stat(directory)
+        with _directory_cache_lock:
+            handle = _directory_cache.pop(directory, None)
+            if handle is not None and handle.key != (st.st_dev, st.st_ino):
+                _evict_directory_handle(handle)
+                handle = None
+            if handle is None:
+                handle = _DirectoryHandle(directory)
+            _directory_cache[directory] = handle
+            while len(_directory_cache) > _directory_cache_size:
+                _evict_directory_handle(
+                    _directory_cache.popitem(last=False)[1])
+            handle.users += 1
+        return handle
+
+    def _release_directory_handle(handle):
+        with _directory_cache_lock:
+            handle.users -= 1
+            if handle.evicted and not handle.users:
+                handle.close()
+
     def _sync_directory(directory):
         # Ensure that filenames are written to disk
-        fd = os.open(directory, 0)
+        handle = _get_directory_handle(directory)
         try:
-            _proper_fsync(fd)
+            _durable_fsync(handle.fd)
+        except OSError:
+            with _directory_cache_lock:
+                if _directory_cache.get(directory) is handle:
+                    del _directory_cache[directory]
+                    handle.evicted = True
+            raise
+        finally:
+            _release_directory_handle(handle)
+
+    def _sync_file(path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            _data_fsync(fd)
         finally:
             os.close(fd)
 
-    def _replace_atomic(src, dst):
-        os.rename(src, dst)
-        _sync_directory(os.path.normpath(os.path.dirname(dst)))
+    _renameat2 = None
+    _linkat = None
+    _fallocate = None
+    if sys.platform.startswith('linux'):
+        try:
+            import ctypes
+            _libc = ctypes.CDLL(None, use_errno=True)
+        except (ImportError, OSError):
+            pass
+        else:
+            # glibc < 2.28 doesn't have a wrapper for renameat2(2).
+            _renameat2 = getattr(_libc, 'renameat2', None)
+            if _renameat2 is not None:
+                _renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                       ctypes.c_int, ctypes.c_char_p,
+                                       ctypes.c_uint]
+                _renameat2.restype = ctypes.c_int
+            # os.link() doesn't pass AT_SYMLINK_FOLLOW, which is needed to
+            # link a file through /proc/self/fd.
+            _linkat = getattr(_libc, 'linkat', None)
+            if _linkat is not None:
+                _linkat.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_int]
+                _linkat.restype = ctypes.c_int
+            # Unlike os.posix_fallocate(), this can reserve space without
+            # changing the file size.
+            _fallocate = getattr(_libc, 'fallocate64', None)
+            if _fallocate is not None:
+                _fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                                       ctypes.c_int64, ctypes.c_int64]
+                _fallocate.restype = ctypes.c_int
+
+    _AT_FDCWD = -100
+    _AT_SYMLINK_FOLLOW = 0x400
+    _RENAME_NOREPLACE = 1
+    _FALLOC_FL_KEEP_SIZE = 1
+
+    def _preallocate(fd, size):
+        # The file size must stay the amount of data actually written, so
+        # posix_fallocate() is of no use.
+        if _fallocate is None:
+            return
+        if _fallocate(fd, _FALLOC_FL_KEEP_SIZE, 0, size) != 0:
+            err = ctypes.get_errno()
+            # Not supported by the filesystem, it's only an optimization.
+            if err not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+                raise OSError(err, os.strerror(err))
+
+    def _rename_noreplace(src, dst):
+        '''Rename without overwriting ``dst``. Return ``False`` if the kernel
+        or filesystem doesn't support this.'''
+        global _renameat2
+        if _renameat2 is None:
+            return False
+        src_bytes, dst_bytes = _path_to_bytes(src), _path_to_bytes(dst)
+        # c_char_p would silently truncate these, os.rename() refuses them.
+        if b'\0' in src_bytes or b'\0' in dst_bytes:
+            raise ValueError('embedded null byte')
+        rv = _renameat2(_AT_FDCWD, src_bytes, _AT_FDCWD, dst_bytes,
+                        _RENAME_NOREPLACE)
+        if rv == 0:
+            return True
+        err = ctypes.get_errno()
+        if err == errno.ENOSYS:
+            # Kernel < 3.15, don't bother trying again.
+            _renameat2 = None
+            return False
+        if err == errno.EINVAL:
+            # Filesystem doesn't support RENAME_NOREPLACE.
+            return False
+        raise OSError(err, os.strerror(err), dst)
 
-    def _move_atomic(src, dst):
+    def _replace_atomic(src, dst, write_through=True):
+        # write_through only has a meaning on Windows, directories are
+        # synced separately here.
+        os.replace(src, dst)
+
+    def _move_atomic(src, dst, write_through=True):
+        if _rename_noreplace(src, dst):
+            return
         os.link(src, dst)
         os.unlink(src)
 
-        src_dir = os.path.normpath(os.path.dirname(src))
-        dst_dir = os.path.normpath(os.path.dirname(dst))
+    def _sync_parent_directories(src, dst):
+        src_dir = _parent_directory(src)
+        dst_dir = _parent_directory(dst)
         _sync_directory(dst_dir)
         if src_dir != dst_dir:
             _sync_directory(src_dir)
+
+    if (hasattr(os, 'O_TMPFILE') and _linkat is not None and
+            os.path.isdir('/proc/self/fd')):
+        def _open_unnamed(directory):
+            '''Create a file without a directory entry in ``directory``. Return
+            ``None`` if the kernel or filesystem doesn't support this.'''
+            try:
+                return os.open(directory, os.O_RDWR | os.O_TMPFILE, 0o600)
+            except OSError as e:
+                # Old kernels don't know O_TMPFILE and see O_DIRECTORY instead.
+                if e.errno in (errno.EOPNOTSUPP, errno.EISDIR, errno.EINVAL):
+                    return None
+                raise
+
+        def _link_unnamed(fd, directory, prefix, suffix):
+            '''Give a file opened by :py:func:`_open_unnamed` a temporary name
+            and return it.'''
+            while True:
+                name = _temporary_name(directory, prefix, suffix)
+                rv = _linkat(_AT_FDCWD, ('/proc/self/fd/%d' % fd).encode(),
+                             _AT_FDCWD, _path_to_bytes(name),
+                             _AT_SYMLINK_FOLLOW)
+                if rv == 0:
+                    return name
+                err = ctypes.get_errno()
+                if err != errno.EEXIST:
+                    raise OSError(err, os.strerror(err), name)
+    else:
+        _open_unnamed = None
+        _link_unnamed = None
 else:
-    from ctypes import windll, WinError
+    from ctypes import WinDLL, WinError, byref, get_last_error, sizeof
+    from ctypes.wintypes import (BOOL, DWORD, HANDLE, LARGE_INTEGER, LPCWSTR,
+                                 LPVOID)
+    import msvcrt
+
+    # A private instance, so that setting argtypes doesn't affect other users
+    # of ctypes.windll. With use_last_error, ctypes saves the error code right
+    # after each call, before the interpreter gets a chance to overwrite it.
+    _kernel32 = WinDLL('kernel32', use_last_error=True)
+
+    _MoveFileExW = _kernel32.MoveFileExW
+    _MoveFileExW.argtypes = [LPCWSTR, LPCWSTR, DWORD]
+    _MoveFileExW.restype = BOOL
+
+    _ReplaceFileW = _kernel32.ReplaceFileW
+    _ReplaceFileW.argtypes = [LPCWSTR, LPCWSTR, LPCWSTR, DWORD, LPVOID,
+                              LPVOID]
+    _ReplaceFileW.restype = BOOL
+
+    _GetFileAttributesW = _kernel32.GetFileAttributesW
+    _GetFileAttributesW.argtypes = [LPCWSTR]
+    _GetFileAttributesW.restype = DWORD
+
+    _SetFileInformationByHandle = _kernel32.SetFileInformationByHandle
+    _SetFileInformationByHandle.argtypes = [HANDLE, DWORD, LPVOID, DWORD]
+    _SetFileInformationByHandle.restype = BOOL
 
     _MOVEFILE_REPLACE_EXISTING = 0x1
     _MOVEFILE_WRITE_THROUGH = 0x8
-    _windows_default_flags = _MOVEFILE_WRITE_THROUGH
+    _INVALID_FILE_ATTRIBUTES = 0xFFFFFFFF
+    _ERROR_FILE_NOT_FOUND = 2
+    _ERROR_UNABLE_TO_MOVE_REPLACEMENT_2 = 1177
+
+    # Errors caused by other processes (typically virus scanners or search
+    # indexers) briefly holding a handle to one of the files. The
+    # ReplaceFileW errors only leave both files under their original names
+    # because a backup name is always passed, see _replace_atomic.
+    _TRANSIENT_ERRORS = frozenset([
+        5,  # ERROR_ACCESS_DENIED
+        32,  # ERROR_SHARING_VIOLATION
+        1175,  # ERROR_UNABLE_TO_REMOVE_REPLACED
+        1176,  # ERROR_UNABLE_TO_MOVE_REPLACEMENT
+        1177,  # ERROR_UNABLE_TO_MOVE_REPLACEMENT_2, after restoring dst
+    ])
+
+    def _retry(op, max_attempts=20):
+        '''Call ``op`` until it succeeds, backing off exponentially (up to
+        ~10ms) between attempts if it failed with a transient error. ``op``
+        returns ``0`` on success and a Windows error code otherwise.'''
+        for attempt in range(max_attempts):
+            err = op()
+            if not err:
+                return
+            if err not in _TRANSIENT_ERRORS or attempt == max_attempts - 1:
+                raise WinError(err)
+            time.sleep(min(0.01, 0.0001 * (1 << attempt)) *
+                       (0.5 + random.random()))
 
-    def _handle_errors(rv):
-        if not rv:
-            raise WinError()
+    def _windows_flags(write_through):
+        # Waiting for the rename to hit the disk is expensive, only do it if
+        # the caller asked for durability.
+        return _MOVEFILE_WRITE_THROUGH if write_through else 0
 
-    def _replace_atomic(src, dst):
-        _handle_errors(windll.kernel32.MoveFileExW(
-            _path_to_unicode(src), _path_to_unicode(dst),
-            _windows_default_flags | _MOVEFILE_REPLACE_EXISTING
-        ))
+    def _move_file(src, dst, flags):
+        if not _MoveFileExW(src, dst, flags):
+            return get_last_error()
+        return 0
 
-    def _move_atomic(src, dst):
-        _handle_errors(windll.kernel32.MoveFileExW(
-            _path_to_unicode(src), _path_to_unicode(dst),
-            _windows_default_flags
-        ))
+    def _replace_atomic(src, dst, write_through=True):
+        src = _path_to_unicode(src)
+        dst = _path_to_unicode(dst)
+        move_flags = _windows_flags(write_through) | _MOVEFILE_REPLACE_EXISTING
+        if write_through:
+            # ReplaceFileW doesn't support REPLACEFILE_WRITE_THROUGH, only
+            # MoveFileExW can wait for the rename to reach the disk.
+            _retry(lambda: _move_file(src, dst, move_flags))
+            return
+        # Without a backup name, ReplaceFileW may delete dst and then fail to
+        # move src into place (ERROR_UNABLE_TO_MOVE_REPLACEMENT). With one, dst
+        # is never lost.
+        backup = _temporary_name(_parent_directory(dst), tempfile.template, '')
+        backed_up = []
+
+        def replace():
+            if _GetFileAttributesW(dst) != _INVALID_FILE_ATTRIBUTES:
+                if _ReplaceFileW(dst, src, backup, 0, None, None):
+                    backed_up.append(True)
+                    return 0
+                err = get_last_error()
+                if err == _ERROR_UNABLE_TO_MOVE_REPLACEMENT_2:
+                    # dst has been moved to the backup name, restore it
+                    # before trying again.
+                    return _move_file(backup, dst, 0) or err
+                if err != _ERROR_FILE_NOT_FOUND:
+                    return err
+                # dst was removed in the meantime, fall through to a plain
+                # move.
+            return _move_file(src, dst, move_flags)
+
+        _retry(replace)
+        if backed_up:
+            try:
+                os.unlink(backup)
+            except OSError:
+                pass
+
+    def _move_atomic(src, dst, write_through=True):
+        src = _path_to_unicode(src)
+        dst = _path_to_unicode(dst)
+        flags = _windows_flags(write_through)
+        _retry(lambda: _move_file(src, dst, flags))
+
+    def _sync_directory(directory):
+        # With write_through, every rename went through MoveFileExW with
+        # MOVEFILE_WRITE_THROUGH, which already flushed it to disk.
+        pass
+
+    def _sync_parent_directories(src, dst):
+        pass
+
+    _open_unnamed = None
+    _link_unnamed = None
+
+    _FILE_ALLOCATION_INFO = 5
+
+    def _preallocate(fd, size):
+        # Only sets the allocation size, the end of file stays where it is.
+        info = LARGE_INTEGER(size)
+        if not _SetFileInformationByHandle(
+                msvcrt.get_osfhandle(fd), _FILE_ALLOCATION_INFO,
+                byref(info), sizeof(info)):
+            raise WinError(get_last_error())
+
+    def _sync_file(path):
+        # _commit() requires a handle with write access.
+        fd = os.open(path, os.O_RDWR)
+        try:
+            _data_fsync(fd)
+        finally:
+            os.close(fd)
+
+
+_batch_state = threading.local()
+
+
+class _Batch(object):
+    def __init__(self):
+        self.files = set()
+        self.directories = set()
+
+    def update(self, other):
+        self.files.update(other.files)
+        self.directories.update(other.directories)
+
+    def flush(self):
+        # File contents first, so that no directory entry becomes durable
+        # before the data it points to.
+        for path in sorted(self.files):
+            _ignore_missing(_sync_file, path)
+        for directory in sorted(self.directories):
+            _ignore_missing(_sync_directory, directory)
+
+
+def _ignore_missing(sync, path):
+    try:
+        sync(path)
+    except OSError as e:
+        # Removed or renamed since it was written, the new location is not
+        # known anymore.
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _current_batch():
+    stack = getattr(_batch_state, 'stack', None)
+    return stack[-1] if stack else None
+
+
+@contextlib.contextmanager
+def batch_atomic_writes():
+    '''
+    Defer all ``fsync`` calls of atomic writes within this block until it
+    exits::
+
+        with batch_atomic_writes():
+            for path in paths:
+                with atomic_write(path, overwrite=True) as f:
+                    f.write(...)
+
+    Every written file and every affected directory is then flushed exactly
+    once, no matter how often it was written to. Until the block exits,
+    writes are only atomic for concurrent readers: the rename may reach the
+    disk before the data, so after a power loss a target file may be empty or
+    truncated.
+
+    Batches are local to the current thread and may be nested, in which case
+    the outermost batch does the flushing.
+    '''
+    batch = _Batch()
+    stack = _batch_state.__dict__.setdefault('stack', [])
+    stack.append(batch)
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        stack.pop()
+        if stack:
+            stack[-1].update(batch)
+        elif failed:
+            # Still flush what has been committed, but don't hide the
+            # original error.
+            try:
+                batch.flush()
+            except Exception:
+                pass
+        else:
+            batch.flush()
+
+
+def _copy_data(src, dst):
+    '''Copy everything from the unbuffered file ``src`` to ``dst``.'''
+    if hasattr(os, 'copy_file_range'):
+        # Copies inside the kernel, and even shares extents on filesystems
+        # that support reflinks.
+        try:
+            while os.copy_file_range(src.fileno(), dst.fileno(), 1 << 30):
+                pass
+            return
+        except OSError as e:
+            # Not supported across these filesystems or by this kernel. Both
+            # file offsets were advanced by what has been copied so far, so
+            # just continue from there.
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                               errno.EOPNOTSUPP):
+                raise
+    shutil.copyfileobj(src, dst)
+
+
+def _cross_fs_fallback(src, dst, rename, sync=True):
+    '''
+    Copy ``src`` to a temporary file next to ``dst``, atomically move that
+    one into place with ``rename`` and remove ``src``. Used if ``src`` and
+    ``dst`` are on different filesystems.
+    '''
+    descriptor, name = _create_temporary(_parent_directory(dst),
+                                         tempfile.template, '')
+    try:
+        with io.open(src, 'rb', buffering=0) as s, \
+                io.open(descriptor, 'wb', buffering=0) as d:
+            _copy_data(s, d)
+            if sync:
+                _data_fsync(d.fileno())
+        rename(name, dst, write_through=sync)
+    except BaseException:
+        try:
+            os.unlink(name)
+        except OSError:
+            pass
+        raise
+    os.unlink(src)
 
 
 def replace_atomic(src, dst):
@@ -90,7 +545,13 @@ def replace_atomic(src, dst):
     Both paths must reside on the same filesystem for the operation to be
     atomic.
     '''
-    return _replace_atomic(src, dst)
+    _replace_atomic(src, dst)
+    dst_dir = _parent_directory(dst)
+    batch = _current_batch()
+    if batch is not None:
+        batch.directories.add(os.path.abspath(dst_dir))
+    else:
+        _sync_directory(dst_dir)
 
 
 def move_atomic(src, dst):
@@ -102,7 +563,346 @@ def move_atomic(src, dst):
     Both paths must reside on the same filesystem for the operation to be
     atomic.
     '''
-    return _move_atomic(src, dst)
+    _move_atomic(src, dst)
+    batch = _current_batch()
+    if batch is not None:
+        batch.directories.add(os.path.abspath(_parent_directory(src)))
+        batch.directories.add(os.path.abspath(_parent_directory(dst)))
+    else:
+        _sync_parent_directories(src, dst)
+
+
+class _LazyFile(object):
+    '''
+    Proxy for the temporary file that only creates it on disk when it is
+    first used, so that writers aborted before writing anything don't leave
+    (and then have to remove) an empty temporary file. ``opener`` returns the
+    file object and its name, or ``None`` if it has none yet.
+
+    Where supported, the file is created without a name and only linked into
+    its directory once the ``with``-block exits successfully. If the process
+    dies while writing, nothing is left behind.
+    '''
+
+    def __init__(self, opener, directory, prefix, suffix):
+        self._opener = opener
+        self._directory = directory
+        self._prefix = prefix
+        self._suffix = suffix
+        self._file = None
+        self._name = None
+        self._closed = False
+
+    @property
+    def created(self):
+        return self._file is not None
+
+    @property
+    def has_name(self):
+        '''Whether the temporary file has a directory entry.'''
+        return self._name is not None
+
+    @property
+    def name(self):
+        f = self._get_file()
+        if self._name is None:
+            if f.closed:
+                raise ValueError('Unnamed temporary file has been closed.')
+            self._name = _link_unnamed(f.fileno(), self._directory,
+                                       self._prefix, self._suffix)
+        return self._name
+
+    @property
+    def closed(self):
+        if self._file is None:
+            return self._closed
+        return self._file.closed
+
+    # Bound onto the proxy once the file exists, so that these calls no
+    # longer go through ``__getattr__``.
+    _forwarded = ('write', 'writelines', 'read', 'readline', 'readlines',
+                  'flush', 'fileno', 'seek', 'tell', 'truncate')
+
+    def _get_file(self):
+        if self._file is None:
+            if self._closed:
+                raise ValueError('I/O operation on closed file.')
+            self._file, self._name = self._opener()
+            for name in self._forwarded:
+                if hasattr(self._file, name):
+                    setattr(self, name, getattr(self._file, name))
+        return self._file
+
+    def __getattr__(self, name):
+        return getattr(self._get_file(), name)
+
+    def __iter__(self):
+        self._get_file()
+        return self
+
+    def __next__(self):
+        return next(self._get_file())
+
+    def close(self):
+        self._closed = True
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            if exc_type is None and self._file is not None:
+                # An unnamed file is gone once closed, link it before that.
+                self.name
+        finally:
+            self.close()
+
+
+class _Journal(object):
+    '''
+    Appends one JSON line per committed file to ``path``. Entries are written
+    by a background thread in batches, so that committing doesn't wait for
+    the journal.
+    '''
+
+    flush_entries = 50
+    flush_interval = 1.0
+
+    def __init__(self, path):
+        self.path = path
+        # Opened here rather than in the background thread, so that errors
+        # reach the caller.
+        self._file = io.open(path, 'a', encoding='utf-8')
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run,
+                                        name='atomicwrites journal')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def alive(self):
+        return self._thread.is_alive()
+
+    def record(self, path, size, sha256):
+        # Don't pile up entries that nobody is going to write anymore.
+        if self._thread.is_alive():
+            self._queue.put((path, size, sha256, time.time()))
+
+    def close(self):
+        '''Write all pending entries, ``fsync`` the journal and stop the
+        background thread.'''
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        pending = []
+        deadline = None
+        with self._file as f:
+            while True:
+                timeout = None
+                if pending:
+                    timeout = max(0, deadline - time.time())
+                try:
+                    entry = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    entry = False
+
+                if entry:
+                    if not pending:
+                        deadline = time.time() + self.flush_interval
+                    pending.append(entry)
+                    if len(pending) < self.flush_entries:
+                        continue
+
+                if pending:
+                    f.write(u''.join(
+                        json.dumps({'path': path, 'size': size,
+                                    'sha256': sha256, 'time': t},
+                                   sort_keys=True) + u'\n'
+                        for path, size, sha256, t in pending
+                    ))
+                    f.flush()
+                    del pending[:]
+
+                if entry is None:
+                    _data_fsync(f.fileno())
+                    return
+
+
+_journals = {}
+_journals_lock = threading.Lock()
+
+
+def _get_journal(path):
+    path = os.path.abspath(path)
+    with _journals_lock:
+        journal = _journals.get(path)
+        # Start over if writing to the journal failed before.
+        if journal is None or not journal.alive:
+            journal = _journals[path] = _Journal(path)
+        return journal
+
+
+@atexit.register
+def _close_journals():
+    with _journals_lock:
+        journals = list(_journals.values())
+        _journals.clear()
+    for journal in journals:
+        journal.close()
+
+
+class WriteCorruption(OSError):
+    '''
+    Raised by :py:class:`AtomicWriter` with ``verify=True`` if the temporary
+    file doesn't contain what was written to it.
+    '''
+
+
+class _HashingRawIO(io.RawIOBase):
+    '''Raw stream that keeps a SHA-256 hash of everything written through
+    it. Seeking is not supported, since the hash is only meaningful for
+    sequential writes.'''
+
+    def __init__(self, raw):
+        io.RawIOBase.__init__(self)
+        self.raw = raw
+        self.hash = hashlib.sha256()
+        self._pos = 0
+
+    @property
+    def name(self):
+        return self.raw.name
+
+    def fileno(self):
+        return self.raw.fileno()
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def write(self, b):
+        n = self.raw.write(b)
+        if n:
+            self.hash.update(memoryview(b)[:n])
+            self._pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            try:
+                self.raw.close()
+            finally:
+                io.RawIOBase.close(self)
+
+
+def _open_hashing(file, mode, buffering=-1, encoding=None, errors=None,
+                  newline=None, closefd=True, opener=None):
+    '''Like :py:func:`io.open`, but hash all written bytes.'''
+    raw_kwargs = {'closefd': closefd}
+    if opener is not None:
+        raw_kwargs['opener'] = opener
+    raw = _HashingRawIO(io.open(file, 'wb', buffering=0, **raw_kwargs))
+    if buffering == 0:
+        return raw
+    line_buffering = buffering == 1
+    if buffering < 0 or line_buffering:
+        buffering = io.DEFAULT_BUFFER_SIZE
+    buffer = io.BufferedWriter(raw, buffering)
+    if 'b' in mode:
+        return buffer
+    return io.TextIOWrapper(buffer, encoding, errors, newline,
+                            line_buffering=line_buffering)
+
+
+def _hashing_raw(f):
+    '''Find the :py:class:`_HashingRawIO` underneath a file object returned
+    by :py:func:`_open_hashing`.'''
+    # Don't go through the proxy's __getattr__, which would forward ``raw``
+    # past the hashing layer if that is the file itself (buffering=0).
+    raw = f._get_file() if isinstance(f, _LazyFile) else f
+    while not isinstance(raw, _HashingRawIO):
+        raw = raw.buffer if hasattr(raw, 'buffer') else raw.raw
+    return raw
+
+
+def _hash_file(name):
+    '''Read the file ``name`` back, return its size and SHA-256 hash.'''
+    digest = hashlib.sha256()
+    size = 0
+    buf = bytearray(64 * 1024)
+    view = memoryview(buf)
+    with io.open(name, 'rb', buffering=0) as r:
+        while True:
+            n = r.readinto(buf)
+            if not n:
+                break
+            digest.update(view[:n])
+            size += n
+    return size, digest
+
+
+def _verify_file(f, path):
+    '''Compare the contents of the temporary file ``f`` with the hash of the
+    data written to it.'''
+    raw = _hashing_raw(f)
+
+    if isinstance(f, _LazyFile) and not f.has_name:
+        name = '/proc/self/fd/%d' % f.fileno()
+    else:
+        name = f.name
+
+    if _hash_file(name)[1].digest() != raw.hash.digest():
+        raise WriteCorruption(errno.EIO, 'Data read back from temporary file '
+                              'does not match what was written', path)
+
+
+class _AtomicWriterContext(object):
+    '''
+    Context manager returned by :py:meth:`AtomicWriter.open`. Written as a
+    class rather than with :py:func:`contextlib.contextmanager` to avoid the
+    generator overhead for many small writes.
+    '''
+
+    def __init__(self, writer, get_fileobject):
+        self._writer = writer
+        self._get_fileobject = get_fileobject
+        self._cm = None
+        self._f = None
+
+    def __enter__(self):
+        self._cm = self._get_fileobject(**self._writer._open_kwargs)
+        self._f = self._cm.__enter__()
+        return self._f
+
+    def __exit__(self, exc_type, exc_value, tb):
+        writer = self._writer
+        f = self._f
+        success = False
+        try:
+            if exc_type is None:
+                try:
+                    writer.sync(f)
+                except BaseException:
+                    self._cm.__exit__(*sys.exc_info())
+                    raise
+                self._cm.__exit__(None, None, None)
+                writer.commit(f)
+                writer.sync_dir(writer._path, f.name)
+                success = True
+            else:
+                self._cm.__exit__(exc_type, exc_value, tb)
+        finally:
+            if not success:
+                try:
+                    writer.rollback(f)
+                except Exception:
+                    pass
+        return False
 
 
 class AtomicWriter(object):
@@ -113,18 +913,56 @@ class AtomicWriter(object):
             f.write(...)
 
     :param path: The destination filepath. May or may not exist.
-    :param mode: The filemode for the temporary file. This defaults to `wb` in
-        Python 2 and `w` in Python 3.
+    :param mode: The filemode for the temporary file. This defaults to `w`.
     :param overwrite: If set to false, an error is raised if ``path`` exists.
         Errors are only raised after the file has been written to.  Either way,
         the operation is atomic.
+    :param sync: If set to false, neither the temporary file nor the parent
+        directory are ``fsync``-ed, and on Windows the rename is not done with
+        ``MOVEFILE_WRITE_THROUGH``. The write is then only atomic for
+        concurrent readers: after a power loss, the target file may be empty
+        or truncated. Defaults to true. On OS X, only the directory is synced
+        with ``F_FULLFSYNC``, set this to ``'strict'`` to use it for the
+        temporary file too.
+    :param evict_cache: If set to true, the written data is dropped from the
+        operating system's page cache after :py:meth:`sync`. Useful for large
+        files that won't be read again soon. Data that hasn't been written to
+        disk yet can't be dropped, so this has little effect with
+        ``sync=False`` or inside :py:func:`batch_atomic_writes`. Defaults to
+        false.
+    :param verify: If set to true, the temporary file is ``fsync``-ed (even
+        with ``sync=False`` or inside :py:func:`batch_atomic_writes`), read
+        back after :py:meth:`sync` and compared to what was written to it. On a
+        mismatch, :py:exc:`WriteCorruption` is raised and the target file is
+        left untouched. Seeking in the file is not supported in this mode.
+        Defaults to false.
+    :param buffering: The buffer size for the temporary file, see
+        :py:func:`io.open`. Defaults to 64 KiB, pass a smaller value when
+        writing many small files concurrently.
+    :param allow_cross_fs: If set to true and the temporary file turns out to
+        be on a different filesystem than ``path`` (e.g. because of a custom
+        ``dir``), its contents are copied to a second temporary file next to
+        ``path`` instead of failing with ``EXDEV``. A warning is emitted in
+        that case. Defaults to false.
+    :param journal_path: If given, a line with the path, size, SHA-256 and
+        time of every committed file is appended to this file as JSON. Size
+        and hash are computed by reading the temporary file back before it is
+        moved into place. The journal is written asynchronously in batches and
+        only ``fsync``-ed at interpreter exit.
+    :param estimated_size: If given, this many bytes are allocated for the
+        temporary file up front, which reduces fragmentation of large files.
+        The file size is not changed by this, and space that ends up unused is
+        released again in :py:meth:`sync`. Only supported on Linux and
+        Windows.
 
     If you need further control over the exact behavior, you are encouraged to
     subclass.
     '''
 
-    def __init__(self, path, mode=DEFAULT_MODE, overwrite=False,
-                 **open_kwargs):
+    def __init__(self, path, mode=DEFAULT_MODE, overwrite=False, sync=True,
+                 evict_cache=False, verify=False,
+                 buffering=_DEFAULT_BUFFERING, allow_cross_fs=False,
+                 journal_path=None, estimated_size=None, **open_kwargs):
         if 'a' in mode:
             raise ValueError(
                 'Appending to an existing file is not supported, because that '
@@ -136,10 +974,21 @@ class AtomicWriter(object):
             raise ValueError('Use the `overwrite`-parameter instead.')
         if 'w' not in mode:
             raise ValueError('AtomicWriters can only be written to.')
+        if (verify or journal_path is not None) and '+' in mode:
+            raise ValueError('Reading is not supported with `verify` or '
+                             '`journal_path`.')
 
         self._path = path
         self._mode = mode
         self._overwrite = overwrite
+        self._do_fsync = bool(sync)
+        self._strict_fsync = sync == 'strict'
+        self._evict_cache = evict_cache
+        self._verify = verify
+        self._allow_cross_fs = allow_cross_fs
+        self._journal_path = journal_path
+        self._estimated_size = estimated_size
+        open_kwargs['buffering'] = buffering
         self._open_kwargs = open_kwargs
 
     def open(self):
@@ -148,53 +997,132 @@ class AtomicWriter(object):
         '''
         return self._open(self.get_fileobject)
 
-    @contextlib.contextmanager
     def _open(self, get_fileobject):
-        f = None  # make sure f exists even if get_fileobject() fails
-        try:
-            success = False
-            with get_fileobject(**self._open_kwargs) as f:
-                yield f
-                self.sync(f)
-            self.commit(f)
-            success = True
-        finally:
-            if not success:
-                try:
-                    self.rollback(f)
-                except Exception:
-                    pass
+        return _AtomicWriterContext(self, get_fileobject)
 
     def get_fileobject(self, suffix="", prefix=tempfile.template, dir=None,
                        **kwargs):
-        '''Return the temporary file to use.'''
+        '''Return the temporary file to use. It is only created on disk once
+        it is used, which is why this returns a proxy rather than an
+        :py:class:`io.IOBase` instance.'''
         if dir is None:
-            dir = os.path.normpath(os.path.dirname(self._path))
-        descriptor, name = tempfile.mkstemp(suffix=suffix, prefix=prefix,
-                                            dir=dir)
-        # io.open() will take either the descriptor or the name, but we need
-        # the name later for commit()/replace_atomic() and couldn't find a way
-        # to get the filename from the descriptor.
-        os.close(descriptor)
-        kwargs['mode'] = self._mode
-        kwargs['file'] = name
-        return io.open(**kwargs)
+            dir = _parent_directory(self._path)
+        kwargs.setdefault('buffering', _DEFAULT_BUFFERING)
+
+        if self._verify:
+            open_file = _open_hashing
+        else:
+            open_file = io.open
+
+        def opener():
+            kwargs['mode'] = self._mode
+            descriptor = name = None
+            if _open_unnamed is not None:
+                descriptor = _open_unnamed(dir)
+            if descriptor is None:
+                flags = 0
+                if self._evict_cache:
+                    # Lets the Windows cache manager drop written pages early.
+                    flags |= _O_SEQUENTIAL
+                descriptor, name = _create_temporary(dir, prefix, suffix,
+                                                     flags)
+            try:
+                if self._estimated_size:
+                    _preallocate(descriptor, self._estimated_size)
+            except BaseException:
+                os.close(descriptor)
+                if name is not None:
+                    os.unlink(name)
+                raise
+            kwargs['file'] = descriptor
+            try:
+                return open_file(**kwargs), name
+            except Exception:
+                # io.open() already closed the descriptor.
+                if name is not None:
+                    os.unlink(name)
+                raise
+
+        return _LazyFile(opener, dir, prefix, suffix)
 
     def sync(self, f):
         '''responsible for clearing as many file caches as possible before
         commit'''
         f.flush()
-        _proper_fsync(f.fileno())
+        if self._estimated_size:
+            # Release space that was reserved but not written to.
+            fd = f.fileno()
+            os.ftruncate(fd, os.fstat(fd).st_size)
+        # verify needs the data on disk, otherwise it would only be read back
+        # from the page cache. That holds with sync=False and in batches too.
+        if self._verify or (self._do_fsync and _current_batch() is None):
+            if self._strict_fsync:
+                _durable_fsync(f.fileno())
+            else:
+                # The drive cache is flushed together with the directory
+                # after commit().
+                _data_fsync(f.fileno())
+        if ((self._evict_cache or self._verify) and
+                hasattr(os, 'posix_fadvise')):
+            # Nothing is going to read the file back soon, don't push other
+            # data out of the page cache for it. With verify, this makes sure
+            # the data is actually read back from disk. Dirty pages are kept,
+            # so this does little if the file wasn't fsync-ed above.
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        if self._verify:
+            _verify_file(f, self._path)
 
     def commit(self, f):
         '''Move the temporary file to the target location.'''
-        if self._overwrite:
-            replace_atomic(f.name, self._path)
+        journal = entry = None
+        if self._journal_path is not None:
+            # Prepare everything now, nothing may fail once the target has
+            # been replaced.
+            journal = _get_journal(self._journal_path)
+            # Read back rather than hashed while writing, so that the file
+            # object stays seekable.
+            size, digest = _hash_file(f.name)
+            entry = (os.path.abspath(self._path), size, digest.hexdigest())
+
+        rename = _replace_atomic if self._overwrite else _move_atomic
+        try:
+            rename(f.name, self._path, write_through=self._do_fsync)
+        except OSError as e:
+            if not self._allow_cross_fs or e.errno != errno.EXDEV:
+                raise
+            warnings.warn('{!r} is on a different filesystem than its '
+                          'temporary file, copying it instead.'
+                          .format(self._path), RuntimeWarning)
+            _cross_fs_fallback(f.name, self._path, rename,
+                               sync=self._do_fsync)
+        if journal is not None:
+            journal.record(*entry)
+
+    def sync_dir(self, path, temp_path=None):
+        '''Flush the directory entry of ``path`` to disk after
+        :py:meth:`commit`. Without ``overwrite``, the temporary file was
+        moved away from ``temp_path``, whose directory is flushed too.'''
+        if not self._do_fsync:
+            return
+        directory = _parent_directory(path)
+        moved_from = None if self._overwrite else temp_path
+        batch = _current_batch()
+        if batch is not None:
+            # sync() skipped the file, flush it together with the batch.
+            batch.files.add(os.path.abspath(path))
+            batch.directories.add(os.path.abspath(directory))
+            if moved_from is not None:
+                batch.directories.add(
+                    os.path.abspath(_parent_directory(moved_from)))
+        elif moved_from is not None:
+            _sync_parent_directories(moved_from, path)
         else:
-            move_atomic(f.name, self._path)
+            _sync_directory(directory)
 
     def rollback(self, f):
         '''Clean up all temporary resources.'''
+        if isinstance(f, _LazyFile) and not f.has_name:
+            return
         os.unlink(f.name)
 
 
@@ -212,5 +1140,11 @@ def atomic_write(path, writer_cls=AtomicWriter, **cls_kwargs):
 
     Additional keyword arguments are passed to the writer class. See
     :py:class:`AtomicWriter`.
+
+    The object bound by the ``with`` statement is a proxy that only creates
+    the temporary file once it is used. It behaves like the file object
+    returned by :py:func:`io.open`, but is not an instance of
+    :py:class:`io.IOBase` or its subclasses, so ``isinstance`` checks like
+    ``isinstance(f, io.TextIOBase)`` fail.
     '''
     return writer_cls(path, **cls_kwargs).open()
@@ -1,7 +1,7 @@
 import errno
 import os
 
-from atomicwrites import atomic_write
+from atomicwrites import WriteCorruption, atomic_write, batch_atomic_writes
 
 import pytest
 
@@ -89,3 +89,496 @@ def test_atomic_write_in_pwd(tmpdir):
         assert len(tmpdir.listdir()) == 1
     finally:
         os.chdir(orig_curdir)
+
+
+def test_atomic_write_without_sync(tmpdir, monkeypatch):
+    import atomicwrites
+
+    def fail(*args):
+        assert False, 'fsync should not be called'
+
+    monkeypatch.setattr(atomicwrites, '_data_fsync', fail)
+    monkeypatch.setattr(atomicwrites, '_durable_fsync', fail)
+    monkeypatch.setattr(atomicwrites, '_sync_directory', fail)
+
+    fname = tmpdir.join('ha')
+    with atomic_write(str(fname), overwrite=True, sync=False) as f:
+        f.write('hoho')
+
+    assert fname.read() == 'hoho'
+    assert len(tmpdir.listdir()) == 1
+
+
+def test_atomic_write_syncs_temporary_directory(tmpdir, monkeypatch):
+    import atomicwrites
+
+    synced = []
+    monkeypatch.setattr(atomicwrites, '_sync_directory', synced.append)
+
+    fname = tmpdir.join('ha')
+    tempdir = tmpdir.mkdir('temp')
+    with atomic_write(str(fname), dir=str(tempdir)) as f:
+        f.write('hoho')
+
+    assert fname.read() == 'hoho'
+    assert sorted(synced) == sorted([str(tmpdir), str(tempdir)])
+    assert not tempdir.listdir()
+
+
+def test_batch_atomic_writes(tmpdir, monkeypatch):
+    import atomicwrites
+
+    synced = []
+    monkeypatch.setattr(atomicwrites, '_data_fsync', synced.append)
+    monkeypatch.setattr(atomicwrites, '_durable_fsync', synced.append)
+
+    with batch_atomic_writes():
+        for i in range(3):
+            for name in ('a', 'b'):
+                with atomic_write(str(tmpdir.join(name)),
+                                  overwrite=True) as f:
+                    f.write('hoho')
+        assert not synced
+
+    # Two files and one directory, each flushed once.
+    assert len(synced) == 3
+    assert tmpdir.join('a').read() == 'hoho'
+    assert tmpdir.join('b').read() == 'hoho'
+    assert len(tmpdir.listdir()) == 2
+
+
+def test_embedded_null_byte(tmpdir):
+    from atomicwrites import move_atomic
+
+    fname = tmpdir.join('ha')
+    with pytest.raises(ValueError):
+        with atomic_write(str(fname) + '\0.evil') as f:
+            f.write('hoho')
+
+    src = tmpdir.join('src')
+    src.write('hoho')
+    with pytest.raises(ValueError):
+        move_atomic(str(src), str(fname) + '\0.evil')
+
+    assert tmpdir.listdir() == [src]
+
+
+def test_move_atomic_without_renameat2(tmpdir, monkeypatch):
+    import atomicwrites
+    monkeypatch.setattr(atomicwrites, '_renameat2', None, raising=False)
+    test_atomic_write(tmpdir)
+    test_dont_remove_simultaneously_created_file(tmpdir.mkdir('sub'))
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='No directory fsync on Windows')
+def test_directory_handle_cache(tmpdir):
+    import atomicwrites
+
+    directory = tmpdir.mkdir('sub')
+    fname = directory.join('ha')
+    with atomic_write(str(fname), overwrite=True) as f:
+        f.write('hoho')
+    handle = atomicwrites._directory_cache[str(directory)]
+
+    with atomic_write(str(fname), overwrite=True) as f:
+        f.write('haha')
+    assert atomicwrites._directory_cache[str(directory)] is handle
+
+    # A recreated directory must not be synced through the stale handle.
+    directory.remove()
+    directory = tmpdir.mkdir('sub')
+    with atomic_write(str(fname), overwrite=True) as f:
+        f.write('hehe')
+    assert atomicwrites._directory_cache[str(directory)] is not handle
+    assert handle.fd is None
+    assert fname.read() == 'hehe'
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='No directory fsync on Windows')
+def test_directory_handle_closed_after_eviction(tmpdir, monkeypatch):
+    import atomicwrites
+    monkeypatch.setattr(atomicwrites, '_directory_cache_size', 1)
+
+    handle = atomicwrites._get_directory_handle(str(tmpdir.mkdir('a')))
+    atomicwrites._sync_directory(str(tmpdir.mkdir('b')))
+    # Still in use, must not be closed under the user's feet.
+    assert handle.fd is not None
+
+    atomicwrites._release_directory_handle(handle)
+    assert handle.fd is None
+
+
+def test_teardown_before_write_creates_no_tempfile(tmpdir, monkeypatch):
+    import atomicwrites
+
+    def fail(*args, **kwargs):
+        assert False, 'no temporary file should be created'
+
+    monkeypatch.setattr(atomicwrites, '_open_unnamed', fail)
+    monkeypatch.setattr(atomicwrites, '_create_temporary', fail)
+
+    fname = tmpdir.join('ha')
+    with pytest.raises(ValueError):
+        with atomic_write(str(fname), overwrite=True):
+            raise ValueError()
+
+    assert not tmpdir.listdir()
+
+
+def test_atomic_write_empty_file(tmpdir):
+    fname = tmpdir.join('ha')
+    with atomic_write(str(fname)):
+        pass
+
+    assert fname.read() == ''
+    assert len(tmpdir.listdir()) == 1
+
+
+def test_atomic_write_iterate(tmpdir):
+    fname = tmpdir.join('ha')
+    with atomic_write(str(fname), mode='w+') as f:
+        f.write('ha\nho\n')
+        f.seek(0)
+        assert [line for line in f] == ['ha\n', 'ho\n']
+
+    assert fname.read() == 'ha\nho\n'
+
+
+def test_no_tempfile_visible_while_writing(tmpdir):
+    import atomicwrites
+    if atomicwrites._open_unnamed is None:
+        pytest.skip('O_TMPFILE is not supported')
+
+    fname = tmpdir.join('ha')
+    with atomic_write(str(fname), overwrite=True) as f:
+        f.write('hoho')
+        assert not tmpdir.listdir()
+
+    assert fname.read() == 'hoho'
+    assert len(tmpdir.listdir()) == 1
+
+
+def test_unnamed_tempfile_closed_if_link_fails(tmpdir, monkeypatch):
+    import atomicwrites
+    if atomicwrites._open_unnamed is None:
+        pytest.skip('O_TMPFILE is not supported')
+
+    def fail(*args):
+        raise OSError(errno.ENOSPC, 'No space left on device')
+
+    monkeypatch.setattr(atomicwrites, '_link_unnamed', fail)
+
+    fname = tmpdir.join('ha')
+    with pytest.raises(OSError):
+        with atomic_write(str(fname), overwrite=True) as f:
+            f.write('hoho')
+
+    assert f.closed
+    assert not tmpdir.listdir()
+
+
+def test_atomic_write_without_o_tmpfile(tmpdir, monkeypatch):
+    import atomicwrites
+    monkeypatch.setattr(atomicwrites, '_open_unnamed', None)
+    test_atomic_write(tmpdir)
+    test_teardown(tmpdir.mkdir('sub'))
+
+
+def test_atomic_write_strict_sync(tmpdir, monkeypatch):
+    import atomicwrites
+
+    synced = []
+    monkeypatch.setattr(atomicwrites, '_data_fsync',
+                        lambda fd: synced.append('data'))
+    monkeypatch.setattr(atomicwrites, '_durable_fsync',
+                        lambda fd: synced.append('durable'))
+
+    fname = tmpdir.join('ha')
+    with atomic_write(str(fname), overwrite=True) as f:
+        f.write('hoho')
+    with atomic_write(str(fname), overwrite=True, sync='strict') as f:
+        f.write('haha')
+
+    expected = ['data', 'durable', 'durable', 'durable']
+    if os.name == 'nt':
+        # No directory syncs.
+        expected = ['data', 'durable']
+    assert synced == expected
+    assert fname.read() == 'haha'
+
+
+def test_atomic_write_evict_cache(tmpdir, monkeypatch):
+    if not hasattr(os, 'posix_fadvise'):
+        pytest.skip('posix_fadvise is not available')
+
+    advised = []
+    posix_fadvise = os.posix_fadvise
+
+    def fadvise(fd, offset, length, advice):
+        advised.append((fd, offset, length, advice))
+        posix_fadvise(fd, offset, length, advice)
+
+    monkeypatch.setattr(os, 'posix_fadvise', fadvise)
+
+    fname = tmpdir.join('ha')
+    with atomic_write(str(fname), overwrite=True, evict_cache=True) as f:
+        f.write('hoho')
+        fd = f.fileno()
+
+    assert (fd, 0, 0, os.POSIX_FADV_DONTNEED) in advised
+    assert fname.read() == 'hoho'
+    assert len(tmpdir.listdir()) == 1
+
+
+@pytest.mark.parametrize('mode,buffering', [
+    ('w', -1),
+    ('wb', -1),
+    ('wb', 0),
+])
+def test_atomic_write_verify(tmpdir, mode, buffering):
+    fname = tmpdir.join('ha')
+    with atomic_write(str(fname), mode=mode, overwrite=True, verify=True,
+                      buffering=buffering) as f:
+        f.write(b'hoho\n' if 'b' in mode else u'hoho\n')
+
+    assert fname.read() == 'hoho\n'
+    assert len(tmpdir.listdir()) == 1
+
+
+def test_atomic_write_verify_corruption(tmpdir):
+    fname = tmpdir.join('ha')
+    with pytest.raises(WriteCorruption):
+        with atomic_write(str(fname), overwrite=True, verify=True) as f:
+            f.write('hoho')
+            f.flush()
+            # Simulate the disk returning different data.
+            with open(f.name, 'r+') as other:
+                other.write('haha')
+
+    assert not tmpdir.listdir()
+
+
+def test_atomic_write_verify_syncs_first(tmpdir, monkeypatch):
+    import atomicwrites
+
+    events = []
+    monkeypatch.setattr(atomicwrites, '_data_fsync',
+                        lambda fd: events.append('fsync'))
+    verify_file = atomicwrites._verify_file
+
+    def verify(f, path):
+        events.append('verify')
+        verify_file(f, path)
+
+    monkeypatch.setattr(atomicwrites, '_verify_file', verify)
+
+    fname = tmpdir.join('ha')
+    with batch_atomic_writes():
+        with atomic_write(str(fname), overwrite=True, verify=True) as f:
+            f.write('hoho')
+    with atomic_write(str(fname), overwrite=True, verify=True,
+                      sync=False) as f:
+        f.write('haha')
+
+    assert events[:2] == ['fsync', 'verify']
+    assert events[-2:] == ['fsync', 'verify']
+    assert fname.read() == 'haha'
+
+
+def test_atomic_write_buffering(tmpdir):
+    fname = tmpdir.join('ha')
+    with atomic_write(str(fname), mode='wb', overwrite=True) as f:
+        f.write(b'x' * 32 * 1024)
+        assert os.fstat(f.fileno()).st_size == 0
+
+    with atomic_write(str(fname), mode='wb', overwrite=True,
+                      buffering=0) as f:
+        f.write(b'hoho')
+        assert os.fstat(f.fileno()).st_size == 4
+
+    assert fname.read() == 'hoho'
+
+
+@pytest.mark.parametrize('overwrite', [True, False])
+def test_atomic_write_cross_fs(tmpdir, monkeypatch, overwrite):
+    import atomicwrites
+
+    fname = tmpdir.join('ha')
+    name = '_replace_atomic' if overwrite else '_move_atomic'
+    rename = getattr(atomicwrites, name)
+    calls = []
+
+    def cross_fs_rename(src, dst, **kwargs):
+        calls.append(src)
+        if len(calls) == 1:
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        return rename(src, dst, **kwargs)
+
+    monkeypatch.setattr(atomicwrites, name, cross_fs_rename)
+
+    with pytest.raises(OSError) as excinfo:
+        with atomic_write(str(fname), overwrite=overwrite) as f:
+            f.write('hoho')
+    assert excinfo.value.errno == errno.EXDEV
+    assert not tmpdir.listdir()
+
+    del calls[:]
+    with pytest.warns(RuntimeWarning):
+        with atomic_write(str(fname), overwrite=overwrite,
+                          allow_cross_fs=True) as f:
+            f.write('hoho')
+
+    assert len(calls) == 2
+    assert fname.read() == 'hoho'
+    assert len(tmpdir.listdir()) == 1
+
+
+def test_atomic_write_journal(tmpdir):
+    import hashlib
+    import json
+    import atomicwrites
+
+    journal = tmpdir.join('journal.jsonl')
+    fname = tmpdir.join('ha')
+    for content in ('hoho', 'haha\n'):
+        with atomic_write(str(fname), overwrite=True,
+                          journal_path=str(journal)) as f:
+            f.write(content)
+
+    atomicwrites._close_journals()
+
+    entries = [json.loads(line) for line in journal.readlines()]
+    assert [e['path'] for e in entries] == [str(fname)] * 2
+    assert [e['size'] for e in entries] == [4, 4 + len(os.linesep)]
+    assert entries[0]['sha256'] == hashlib.sha256(b'hoho').hexdigest()
+
+
+def test_atomic_write_estimated_size(tmpdir):
+    fname = tmpdir.join('ha')
+    data = b'hoho' * 1024
+    with atomic_write(str(fname), mode='wb', overwrite=True,
+                      estimated_size=len(data)) as f:
+        f.write(data)
+
+    assert fname.read_binary() == data
+    assert len(tmpdir.listdir()) == 1
+
+
+def test_atomic_write_estimated_size_too_large(tmpdir):
+    import hashlib
+    import json
+    import atomicwrites
+
+    journal = tmpdir.join('journal.jsonl')
+    fname = tmpdir.join('ha')
+    with atomic_write(str(fname), mode='wb', overwrite=True, verify=True,
+                      journal_path=str(journal), estimated_size=100) as f:
+        f.write(b'hoho' * 2)
+        f.flush()
+        assert os.fstat(f.fileno()).st_size == 8
+
+    atomicwrites._close_journals()
+
+    assert fname.read_binary() == b'hoho' * 2
+    entry, = [json.loads(line) for line in journal.readlines()]
+    assert entry['size'] == 8
+    assert entry['sha256'] == hashlib.sha256(b'hoho' * 2).hexdigest()
+
+
+def test_atomic_write_verify_line_buffering(tmpdir):
+    fname = tmpdir.join('ha')
+    with atomic_write(str(fname), overwrite=True, verify=True,
+                      buffering=1) as f:
+        assert f.line_buffering
+        f.write('hoho\n')
+        assert os.fstat(f.fileno()).st_size == 4 + len(os.linesep)
+
+    assert fname.read() == 'hoho\n'
+
+
+def test_atomic_write_journal_unbuffered(tmpdir):
+    import json
+    import atomicwrites
+
+    journal = tmpdir.join('journal.jsonl')
+    fname = tmpdir.join('ha')
+    with atomic_write(str(fname), mode='wb', overwrite=True, buffering=0,
+                      journal_path=str(journal)) as f:
+        f.write(b'hoho')
+
+    atomicwrites._close_journals()
+
+    entry, = [json.loads(line) for line in journal.readlines()]
+    assert entry['size'] == 4
+    assert fname.read() == 'hoho'
+
+
+def test_atomic_write_journal_seekable(tmpdir):
+    import hashlib
+    import json
+    import atomicwrites
+
+    journal = tmpdir.join('journal.jsonl')
+    fname = tmpdir.join('ha')
+    with atomic_write(str(fname), mode='wb', overwrite=True,
+                      journal_path=str(journal)) as f:
+        f.write(b'haha')
+        assert f.tell() == 4
+        f.seek(0)
+        f.write(b'ho')
+
+    atomicwrites._close_journals()
+
+    entry, = [json.loads(line) for line in journal.readlines()]
+    assert entry['size'] == 4
+    assert entry['sha256'] == hashlib.sha256(b'hoha').hexdigest()
+    assert fname.read() == 'hoha'
+
+
+def test_atomic_write_journal_not_writable(tmpdir):
+    journal = tmpdir.join('missing', 'journal.jsonl')
+    fname = tmpdir.join('ha')
+    with pytest.raises(OSError):
+        with atomic_write(str(fname), journal_path=str(journal)) as f:
+            f.write('hoho')
+
+    assert not tmpdir.listdir()
+
+
+def test_journal_stops_queueing_when_writer_died(tmpdir):
+    import atomicwrites
+
+    path = str(tmpdir.join('journal.jsonl'))
+    journal = atomicwrites._get_journal(path)
+    journal.close()
+    assert not journal.alive
+
+    journal.record('ha', 4, 'hash')
+    assert journal._queue.empty()
+    assert atomicwrites._get_journal(path) is not journal
+    atomicwrites._close_journals()
+
+
+def test_batch_atomic_writes_file_removed(tmpdir):
+    fname = tmpdir.join('ha')
+    with batch_atomic_writes():
+        with atomic_write(str(fname), overwrite=True) as f:
+            f.write('hoho')
+        fname.remove()
+
+    assert not tmpdir.listdir()
+
+
+def test_batch_atomic_writes_reraise(tmpdir, monkeypatch):
+    import atomicwrites
+
+    def fail(path):
+        raise OSError(errno.EIO, 'flush failed')
+
+    monkeypatch.setattr(atomicwrites, '_sync_file', fail)
+
+    with pytest.raises(ValueError):
+        with batch_atomic_writes():
+            with atomic_write(str(tmpdir.join('ha')), overwrite=True) as f:
+                f.write('hoho')
+            raise ValueError()